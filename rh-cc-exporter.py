@@ -1,20 +1,118 @@
 import argparse
 import getpass
-import random
-from dataclasses import dataclass
+import json
+import os
+import threading
+import time
+import uuid
 from datetime import datetime
 from decimal import Decimal
+from typing import NamedTuple
 
+import orjson
 import requests
 import quiffen
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 AUTH_ENDPOINT = "https://api.robinhood.com/creditcard/auth/login/"
 GRAPHQL_ENDPOINT = "https://api.robinhood.com/creditcard/graphql"
 OUTPUT_FILENAME = "./rh-cc-transactions.qif"
 
+# Number of transactions requested per page. The app itself asks for 40, which
+# is used as a fallback if the server rejects the larger page size.
+PAGE_LIMIT = 200
+FALLBACK_PAGE_LIMIT = 40
 
-@dataclass
-class Transaction:
+CUSTOMER_ID_QUERY = """
+    query CriticalDataLoaderQuery {
+        authIdentity {
+            creditCustomers {
+                id
+            }
+        }
+    }
+"""
+
+TRANSACTIONS_QUERY = """
+    query TransactionListQuery(
+        $q: TransactionSearchRequest!
+    ) {
+        transactionSearch(q: $q) {
+            items {
+                id
+                amountMicro
+                flow
+                transactionStatus
+                transactionAt
+                visibility
+                merchantDetails {
+                    merchantName
+                }
+            }
+            cursor
+        }
+    }
+"""
+
+TOKEN_CACHE_PATH = os.path.expanduser("~/.cache/rh-cc-exporter/token.json")
+
+
+class AuthExpiredError(Exception):
+    """
+    Raised when the API rejects the auth token, e.g. because it expired.
+    """
+
+
+class GraphQLError(Exception):
+    """
+    Raised when a graphql response reports errors instead of data.
+    """
+
+
+def create_session():
+    """
+    Create a session shared by every request to the Robinhood API.
+
+    Login and graphql requests use separate adapters with different retry
+    policies, and each adapter keeps its own connection pool. Within a pool
+    the connection is kept alive, so only the first request to each endpoint
+    pays for a TCP and TLS handshake, not every call and page of transactions.
+    """
+    session = requests.Session()
+    # Login only retries failed connections. Resending the password and a
+    # one-time mfa code after a 429 or 5xx would be rate limited or rejected.
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        ),
+    )
+    # The graphql queries are read-only, so they are safe to retry even though
+    # they are sent as POST, which urllib3 does not retry by default.
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["POST"],
+    )
+    session.mount(
+        GRAPHQL_ENDPOINT,
+        HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries),
+    )
+    session.headers.update(
+        {
+            "Content-Type": "application/json",
+            "User-Agent": "rhcardapp/1.35.0 CFNetwork/1498.700.2 Darwin/23.6.0",
+            "x-x1-client": "mobile-app-rh@1.35.0",
+        }
+    )
+    return session
+
+
+class Transaction(NamedTuple):
     """
     Represents a single credit card transaction.
     """
@@ -30,12 +128,10 @@ class Transaction:
     @classmethod
     def from_dict(cls, data):
         # Parse amount into exact representation
-        dollars = str(data["amountMicro"])[:-6]
-        cents = str(data["amountMicro"])[-6:]
-        amount = Decimal(f"{dollars}.{cents}")
+        amount = Decimal(data["amountMicro"]).scaleb(-6)
 
         # Parse timestamp from unix ms to datetime
-        timestamp = datetime.fromtimestamp(data["transactionAt"] / 1000)
+        timestamp = datetime.fromtimestamp(data["transactionAt"] // 1000)
 
         return cls(
             id=data["id"],
@@ -52,41 +148,91 @@ def generate_device_token():
     """
     Generate a random device token for login.
 
-    Copied from the robin_stocks repo by Joshua M. Fernandes:
+    The token has the same UUID form as the one generated by the robin_stocks
+    repo by Joshua M. Fernandes, but is drawn from the OS CSPRNG:
     https://github.com/jmfernandes/robin_stocks/blob/2e127949973511692e4d54aa64f38f54ddb7cc3a/robin_stocks/robinhood/authentication.py
     """
-    rands = []
-    for i in range(0, 16):
-        r = random.random()
-        rand = 4294967296.0 * r
-        rands.append((int(rand) >> ((3 & i) << 3)) & 255)
+    return str(uuid.uuid4())
+
+
+def load_cached_auth_token():
+    """
+    Return the auth token cached by a previous run if it is still valid.
+
+    Returns None if there is no cached token or it has expired.
+    """
+    try:
+        with open(TOKEN_CACHE_PATH) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get("expires_at", 0) <= time.time():
+        return None
+    return cached.get("access_token")
+
+
+def save_auth_token(auth_token, expires_in):
+    """
+    Cache the auth token on disk, readable only by the current user.
 
-    hexa = []
-    for i in range(0, 256):
-        hexa.append(str(hex(i + 256)).lstrip("0x").rstrip("L")[1:])
+    The token is treated as expired 30 seconds early so it is not used right
+    as the server stops accepting it.
+    """
+    os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), exist_ok=True)
+    fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(
+            {"access_token": auth_token, "expires_at": time.time() + expires_in - 30},
+            f,
+        )
+    os.chmod(TOKEN_CACHE_PATH, 0o600)
+
+
+def clear_cached_auth_token():
+    """
+    Remove the cached auth token so the next run logs in again.
+    """
+    try:
+        os.remove(TOKEN_CACHE_PATH)
+    except FileNotFoundError:
+        pass
 
-    id = ""
-    for i in range(0, 16):
-        id += hexa[rands[i]]
 
-        if (i == 3) or (i == 5) or (i == 7) or (i == 9):
-            id += "-"
+def warm_up_connection(session):
+    """
+    Open a pooled connection to the API ahead of the first real request.
 
-    return id
+    Login and graphql requests use separate connection pools, so both are
+    warmed up. Failures are ignored, the following requests simply connect
+    themselves.
+    """
+    for url in (AUTH_ENDPOINT, GRAPHQL_ENDPOINT):
+        try:
+            session.head(url)
+        except requests.RequestException:
+            pass
 
 
-def fetch_auth_token():
+def fetch_auth_token(session):
     """
     Prompt the user for login credentials and attempt to auth.
 
-    If successful, returns the auth_token. Otherwise raises an error.
+    If successful, caches and returns the auth_token. Otherwise raises an
+    error.
     """
     username = input("username: ")
+
+    # Do the TCP and TLS handshakes while the user types their password and
+    # mfa code so the login and graphql requests can reuse the open connections.
+    threading.Thread(target=warm_up_connection, args=(session,), daemon=True).start()
+
     password = getpass.getpass("password: ")
     mfa_code = getpass.getpass("mfa code: ")
 
+    # The login endpoint expects the credit card app's client headers rather
+    # than the ones set on the session for graphql requests.
     headers = {
-        "Content-Type": "application/json",
         "User-Agent": "Robinhood Credit Card/1.50.3 (iOS 18.1.1;)",
         "x-x1-client": "mobile-app-rh@1.50.3",
     }
@@ -101,171 +247,134 @@ def fetch_auth_token():
         "scope": "credit-card",
         "username": username,
     }
-    response = requests.post(AUTH_ENDPOINT, json=body, headers=headers)
-    assert response.status_code == 200, "Auth request failed"
-
-    results = response.json()
+    response = session.post(AUTH_ENDPOINT, json=body, headers=headers)
+    response.raise_for_status()
+
+    results = orjson.loads(response.content)
+    # The cache is only a speed-up and must never fail a login that worked.
+    try:
+        expires_in = int(results.get("expires_in") or 600)
+        save_auth_token(results["access_token"], expires_in)
+    except (OSError, TypeError, ValueError):
+        pass
     return results["access_token"]
 
 
-def fetch_customer_id(auth_token):
-    query = """
-        query CriticalDataLoaderQuery {
-            authIdentity {
-                id
-                rhUserId
-                roles
-                creditCustomers {
-                    id
-                    capabilities {
-                        feature
-                        scope
-                        mode
-                    }
-                    account {
-                        id
-                    }
-                    displayPrimaryCard {
-                        id
-                    }
-                    externalPrimaryCard {
-                        id
-                    }
-                    rhAppContext {
-                        id
-                        customerStatuses
-                    }
-                }
-                settings {
-                    id
-                    colorScheme
-                    authConditions
-                }
-            }
-        }
-    """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {auth_token}",
-        "User-Agent": "rhcardapp/1.35.0 CFNetwork/1498.700.2 Darwin/23.6.0",
-        "x-x1-client": "mobile-app-rh@1.35.0",
-    }
+def fetch_customer_id(session, auth_token):
+    headers = {"Authorization": f"Bearer {auth_token}"}
     body = {
-        "query": query,
+        "query": CUSTOMER_ID_QUERY,
         "operationName": "CriticalDataLoaderQuery",
         "variables": {},
     }
 
-    response = requests.post(GRAPHQL_ENDPOINT, json=body, headers=headers)
-    assert response.status_code == 200, "Customer id request failed"
+    response = session.post(GRAPHQL_ENDPOINT, json=body, headers=headers)
+    if response.status_code == 401:
+        raise AuthExpiredError("Auth token was rejected")
+    response.raise_for_status()
 
-    results = response.json()
+    results = orjson.loads(response.content)
     return results["data"]["authIdentity"]["creditCustomers"][0]["id"]
 
 
-def fetch_transactions(auth_token, customer_id, cutoff_date):
-    query = """
-        query TransactionListQuery(
-            $q: TransactionSearchRequest!
-        ) {
-            transactionSearch(q: $q) {
-                items {
-                    id
-                    amountMicro
-                    originalAmountMicro
-                    flow
-                    transactionStatus
-                    redemptionStatus
-                    transactionType
-                    transactionAt
-                    visibility
-                    merchantDetails {
-                        merchantName
-                        logoUrl
-                    }
-                    pointEarnings
-                    pointMultiplier
-                    links {
-                        paymentId
-                        creditCustomer {
-                            id
-                            creditCustomerId
-                            name {
-                                id
-                                firstName
-                                lastName
-                            }
-                        }
-                    }
-                    disputeDetails {
-                        eligibility
-                    }
-                }
-                cursor
-            }
-        }
+def fetch_transactions(session, auth_token, customer_id, cutoff_date):
     """
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {auth_token}",
-        "User-Agent": "rhcardapp/1.35.0 CFNetwork/1498.700.2 Darwin/23.6.0",
-        "x-x1-client": "mobile-app-rh@1.35.0",
+    Yield visible, posted transactions on or after cutoff_date, newest first.
+
+    Transactions are yielded page by page as they are fetched so only one
+    page of results is held in memory at a time.
+    """
+    headers = {"Authorization": f"Bearer {auth_token}"}
+
+    # Local midnight at the start of the cutoff date in unix ms, so that rows
+    # can be compared against it before they are parsed.
+    cutoff_ms = int(
+        datetime.combine(cutoff_date, datetime.min.time()).timestamp() * 1000
+    )
+
+    # Only the page size and cursor change between requests.
+    search = {
+        "creditCustomerId": customer_id,
+        "filters": {"values": []},
+        "sortDetails": {"field": "TIME", "ascending": False},
+    }
+    body = {
+        "query": TRANSACTIONS_QUERY,
+        "variables": {"q": search},
+        "operationName": "TransactionListQuery",
     }
 
-    transactions = []
     cursor = None
+    limit = PAGE_LIMIT
     while True:
-        body = {
-            "query": query,
-            "variables": {
-                "q": {
-                    "creditCustomerId": customer_id,
-                    "filters": {"values": []},
-                    "sortDetails": {"field": "TIME", "ascending": False},
-                    "limit": 40,
-                }
-            },
-            "operationName": "TransactionListQuery",
-        }
+        search["limit"] = limit
         if cursor:
-            body["variables"]["q"]["cursor"] = cursor
-
-        response = requests.post(GRAPHQL_ENDPOINT, json=body, headers=headers)
-        assert response.status_code == 200, "Transactions request failed"
+            search["cursor"] = cursor
+
+        response = session.post(GRAPHQL_ENDPOINT, json=body, headers=headers)
+        if response.status_code == 401:
+            raise AuthExpiredError("Auth token was rejected")
+
+        results = {}
+        if response.status_code != 400:
+            response.raise_for_status()
+            results = orjson.loads(response.content)
+
+        # A page size the server does not accept is rejected with a 400 or with
+        # graphql errors in a 200 response. Only the first page falls back,
+        # later pages were already accepted at the current size.
+        rejected = response.status_code == 400 or results.get("errors")
+        if rejected and cursor is None and limit != FALLBACK_PAGE_LIMIT:
+            limit = FALLBACK_PAGE_LIMIT
+            continue
+        response.raise_for_status()
+        if results.get("errors"):
+            raise GraphQLError(f"Transactions request failed: {results['errors']}")
 
-        results = response.json()
         items = results.get("data", {}).get("transactionSearch").get("items", [])
         cursor = results.get("data", {}).get("transactionSearch").get("cursor", "")
 
+        # Results are sorted newest first, so the first transaction older than
+        # the cutoff means every remaining one is too and no further pages are
+        # requested. The number of requests already scales with the cutoff
+        # window rather than with the age of the account.
         for item in items:
-            item = Transaction.from_dict(item)
-            if item.timestamp.date() < cutoff_date:
-                return transactions
+            if item["transactionAt"] < cutoff_ms:
+                return
 
-            transactions.append(item)
+            # Robinhood app automatically hides a subset of transactions. For
+            # example a merchant may perform a transaction to confirm the card
+            # details are correct.
+            if item["visibility"] != "VISIBLE":
+                continue
 
+            # YNAB does not seem to respect the cleared flag so we only export
+            # transactions that are posted.
+            if item["transactionStatus"] != "POSTED":
+                continue
 
-def main(cutoff_dt):
-    cutoff_date = datetime.strptime(cutoff_dt, "%Y-%m-%d").date()
-    auth_token = fetch_auth_token()
-    customer_id = fetch_customer_id(auth_token)
-    transactions = fetch_transactions(auth_token, customer_id, cutoff_date)
+            yield Transaction.from_dict(item)
+
+        # The server returns no cursor once the whole history has been read.
+        # Without this the first page would be requested again forever.
+        if not cursor:
+            return
+
+
+def build_qif(session, auth_token, cutoff_date):
+    """
+    Fetch all exported transactions on or after cutoff_date into a new Qif.
+
+    Raises AuthExpiredError if the API rejects the auth token at any point.
+    """
+    customer_id = fetch_customer_id(session, auth_token)
 
     qif = quiffen.Qif()
     acc = quiffen.Account(name="RH Gold", desc="RH Gold credit card")
     qif.add_account(acc)
 
+    transactions = fetch_transactions(session, auth_token, customer_id, cutoff_date)
     for transaction in transactions:
-        # Robinhood app automatically hides a subset of transactions. For example
-        # a merchant may perform a transaction to confirm the card details are correct.
-        if transaction.visibility != "VISIBLE":
-            continue
-
-        # YNAB does not seem to respect the cleared flag so we only export
-        # transactions that are posted.
-        if transaction.status != "POSTED":
-            continue
-
         direction = -1 if transaction.flow == "OUTBOUND" else 1
         qif_transaction = quiffen.Transaction(
             date=transaction.timestamp,
@@ -274,6 +383,26 @@ def main(cutoff_dt):
         )
         acc.add_transaction(qif_transaction, header=quiffen.AccountType.CREDIT_CARD)
 
+    return qif
+
+
+def main(cutoff_dt):
+    cutoff_date = datetime.strptime(cutoff_dt, "%Y-%m-%d").date()
+    session = create_session()
+    auth_token = load_cached_auth_token() or fetch_auth_token(session)
+    try:
+        qif = build_qif(session, auth_token, cutoff_date)
+    except AuthExpiredError:
+        # The token was revoked or expired mid-run. Log in again and restart
+        # the export from the first page so no transactions are duplicated.
+        clear_cached_auth_token()
+        auth_token = fetch_auth_token(session)
+        try:
+            qif = build_qif(session, auth_token, cutoff_date)
+        except AuthExpiredError:
+            clear_cached_auth_token()
+            raise
+
     qif.to_qif(OUTPUT_FILENAME)
 
 